@@ -1,6 +1,10 @@
+import collections
+import concurrent.futures
 import os
 import datetime
+import urllib.parse
 
+import requests
 from ws.client.api import API
 
 from .optimizer import Optimizer
@@ -8,22 +12,32 @@ from .optimizer import Optimizer
 
 class Downloader:
     css_url = "https://wiki.archlinuxcn.org/wzh/load.php?lang=%s&modules=site.styles|skins.vector.icons,styles|zzz.ext.archLinux.styles|ext.gadget.heading-counter&only=styles&skin=vector-2022"
+    page_url = "https://wiki.archlinuxcn.org/%s/%s"
+    # log lines for the entries passed through the download pipeline
+    status_formats = {
+        "namespace": "Processing namespace {}...",
+        "skipping": "  [skipping] {}",
+        "up-to-date": "  [up-to-date]  {}",
+        "downloading": "  [downloading] {}",
+    }
 
     def __init__(
         self,
         api: API,
         output_directory: str,
-        epoch: datetime.datetime,
+        epoch: datetime.datetime | None,
         optimizer: Optimizer,
         variant = 'zh',
+        workers: int = 8,
     ):
         """
         Parameters:
         @api:               API object for ArchWiki
         @output_directory:  where to store the downloaded files
         @epoch:             force update of every file older than this date (must be instance
-                            of 'datetime')
+                            of 'datetime'), or None to force update of every file
         @optimizer:         Optimizer instance for HTML post-processing
+        @workers:           number of files downloaded in parallel
         """
 
         self.api = api
@@ -31,6 +45,7 @@ class Downloader:
         self.epoch = epoch
         self.optimizer = optimizer
         self.variant = variant
+        self.workers = workers
         self.css_links = {
             self.css_url % variant: 'ArchWikiOffline.css',
         }
@@ -46,7 +61,7 @@ class Downloader:
         """
         Determine if it is necessary to download a page.
         """
-        if not os.path.exists(fname):
+        if self.epoch is None or not os.path.exists(fname):
             return True
         local = datetime.datetime.fromtimestamp(
             os.path.getmtime(fname), tz=datetime.UTC
@@ -55,47 +70,127 @@ class Downloader:
             return True
         return False
 
-    def process_namespace(self, namespace: str) -> None:
+    def get_page_url(self, title: str) -> str:
         """
-        Enumerate all pages in given namespace, download if necessary
+        Return URL of the page in the selected variant. Built locally instead of
+        requesting inprop=url, which adds three URLs per page to every API batch.
+        """
+        # same set of unescaped characters as MediaWiki's wfUrlencode
+        path = urllib.parse.quote(title.replace(" ", "_"), safe=";@$!*(),/~:")
+        return self.page_url % (self.variant, path)
+
+    def fetch(self, url: str) -> requests.Response:
+        """
+        Download given URL using the shared session, can be called from worker threads.
+        """
+        r = self.api.session.get(url)
+        r.raise_for_status()
+        return r
+
+    def map_parallel(self, func, entries):
         """
-        print(f"Processing namespace {namespace}...")
+        Yield (entry, result) pairs for the (status, title, fname, url) entries
+        in the original order, applying 'func' in worker threads to the entries
+        with the "downloading" status (result is None for the others).
 
+        'entries' is consumed lazily with a bounded number of downloads in
+        flight, so that the downloads overlap with the enumeration of pages
+        from the API, and the consumer sees (and logs) all entries in order.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            in_flight = 0
+            for entry in entries:
+                future = None
+                if entry[0] == "downloading":
+                    future = executor.submit(func, entry)
+                    in_flight += 1
+                pending.append((entry, future))
+                # pass on whatever is ready, wait only when too many downloads are queued
+                while pending and (
+                    pending[0][1] is None
+                    or pending[0][1].done()
+                    or in_flight >= 2 * self.workers
+                ):
+                    entry, future = pending.popleft()
+                    if future is None:
+                        yield entry, None
+                    else:
+                        in_flight -= 1
+                        yield entry, future.result()
+            while pending:
+                entry, future = pending.popleft()
+                yield entry, future.result() if future is not None else None
+
+    def select_outdated(self, entries):
+        """
+        Yield (status, title, fname, url) for the (title, timestamp, url)
+        entries, where status is "skipping", "up-to-date" or "downloading".
+        """
+        for title, timestamp, url in entries:
+            fname = self.optimizer.get_local_filename(title, self.output_directory)
+            if not fname:
+                yield "skipping", title, None, url
+                continue
+            self.files.append(fname)
+            if self.needs_update(fname, timestamp):
+                yield "downloading", title, fname, url
+            else:
+                yield "up-to-date", title, fname, url
+
+    def enumerate_namespace(self, namespace: str):
+        """
+        Enumerate all pages in given namespace, yield (title, timestamp, url) entries
+        """
         allpages = self.api.generator(
             generator="allpages",
             gaplimit="max",
             gapfilterredir="nonredirects",
             gapnamespace=namespace,
             prop="info",
-            inprop="url",
             variant=self.variant,
         )
+        # the URL is built only for pages which are actually downloaded
         for page in allpages:
-            title = page["title"]
-            fname = self.optimizer.get_local_filename(title, self.output_directory)
-            if not fname:
-                print(f"  [skipping] {title}")
-                continue
-            self.files.append(fname)
-            timestamp = page["touched"]
-            if self.needs_update(fname, timestamp):
-                print(f"  [downloading] {title}")
-                fullurl = page["fullurl"].replace('/wiki/', f'/{self.variant}/')
+            yield page["title"], page["touched"], None
 
-                r = self.api.session.get(fullurl)
-                r.raise_for_status()
-                if self.optimizer is not None:
-                    text = self.optimizer.optimize(fname, r.text)
-                else:
-                    text = r.text
+    def process_namespace(self, namespace: str) -> None:
+        """
+        Enumerate all pages in given namespace, download if necessary
+        """
+        self.process_namespaces([namespace])
 
-                # ensure that target directory exists (necessary for subpages)
-                os.makedirs(os.path.dirname(fname), exist_ok=True)
+    def process_namespaces(self, namespaces: list[str]) -> None:
+        """
+        Enumerate all pages in given namespaces, download if necessary.
 
-                with open(fname, "w") as fd:
-                    fd.write(text)
+        The API can list only one namespace at a time, but all of them are fed
+        into one download pipeline so that it does not drain between namespaces.
+        """
+        def entries():
+            for namespace in namespaces:
+                # passed through the pipeline to be logged in the right place
+                yield "namespace", namespace, None, None
+                yield from self.select_outdated(self.enumerate_namespace(namespace))
+
+        # fetch in parallel, but post-process and write in this thread
+        responses = self.map_parallel(
+            lambda entry: self.fetch(self.get_page_url(entry[1])), entries()
+        )
+        for (status, title, fname, _), r in responses:
+            print(self.status_formats[status].format(title))
+            if status != "downloading":
+                continue
+            if self.optimizer is not None:
+                text = self.optimizer.optimize(fname, r.text)
             else:
-                print(f"  [up-to-date]  {title}")
+                text = r.text
+
+            # ensure that target directory exists (necessary for subpages)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+            with open(fname, "w") as fd:
+                fd.write(text)
 
     def download_css(self) -> None:
         print("Downloading CSS...")
@@ -104,32 +199,66 @@ class Downloader:
             fname = os.path.join(self.output_directory, dest)
             if fname:
                 self.files.append(fname)
-                r = self.api.session.get(link)
+                # the stylesheet has no timestamp in the API, let the server
+                # decide whether it changed since the last download, using the
+                # ETag stored in a hidden file next to the local copy (so that
+                # it is not shipped with the documentation)
+                etag_fname = os.path.join(self.output_directory, f".{dest}.etag")
+                headers = {}
+                if (
+                    self.epoch is not None
+                    and os.path.exists(fname)
+                    and os.path.exists(etag_fname)
+                    and datetime.datetime.fromtimestamp(os.path.getmtime(fname), tz=datetime.UTC) >= self.epoch
+                ):
+                    with open(etag_fname, "r") as fd:
+                        headers["If-None-Match"] = fd.read().strip()
+                r = self.api.session.get(link, headers=headers)
                 r.raise_for_status()
+                if r.status_code == 304:
+                    self.files.append(etag_fname)
+                    continue
                 with open(fname, "w") as fd:
                     fd.write(r.text)
+                etag = r.headers.get("ETag")
+                if etag:
+                    with open(etag_fname, "w") as fd:
+                        fd.write(etag)
+                    self.files.append(etag_fname)
+                elif os.path.exists(etag_fname):
+                    os.unlink(etag_fname)
 
     def download_images(self) -> None:
         print("Downloading images...")
         allimages = self.api.list(
             list="allimages", ailimit="max", aiprop="url|timestamp"
         )
-        for image in allimages:
-            title = image["title"]
-            fname = self.optimizer.get_local_filename(title, self.output_directory)
-            if not fname:
-                print(f"  [skipping] {title}")
-                continue
-            self.files.append(fname)
-            timestamp = image["timestamp"]
-            if self.needs_update(fname, timestamp):
-                print(f"  [downloading] {title}")
-                r = self.api.session.get(image["url"])
-                r.raise_for_status()
-                with open(fname, "wb") as fd:
-                    fd.write(r.content)
+        entries = self.select_outdated(
+            (image["title"], image["timestamp"], image["url"]) for image in allimages
+        )
+
+        errors = self.map_parallel(
+            lambda entry: self.save_image(entry[2], entry[3]), entries
+        )
+        for (status, title, _, _), error in errors:
+            if error is None:
+                print(self.status_formats[status].format(title))
             else:
-                print(f"  [up-to-date]  {title}")
+                print(f"  [failed]      {title}: {error}")
+
+    def save_image(self, fname: str, url: str) -> Exception | None:
+        """
+        Download an image into given file, called from worker threads. Errors
+        are returned instead of raised so that one failure does not abort the
+        whole batch.
+        """
+        try:
+            r = self.fetch(url)
+            with open(fname, "wb") as fd:
+                fd.write(r.content)
+        except (requests.RequestException, OSError) as e:
+            return e
+        return None
 
     def clean_output_directory(self) -> None:
         """
@@ -138,7 +267,7 @@ class Downloader:
         """
 
         print("Deleting unwanted files (deleted/moved on the wiki)...")
-        valid_files = self.files.copy()
+        valid_files = set(self.files)
 
         for path, dirs, files in os.walk(self.output_directory, topdown=False):
             # handle files
@@ -1,15 +1,64 @@
+import datetime
 import hashlib
+import json
 import os
 import re
+import sys
 import urllib.parse
 
+import lxml.cssselect
 import lxml.etree
 import lxml.html
 import ws.ArchWiki.lang
 from ws.client.api import API
 
+# matching full URL is necessary for interlanguage links
+wiki_link_re = re.compile(
+    "^(https://wiki.archlinuxcn.org)?/wiki/(?P<title>.+?)(?:#(?P<fragment>.+))?$"
+)
+# cheap pre-check for wiki_link_re, most links on a page are fragments or external
+wiki_link_prefixes = ("/wiki/", "https://wiki.archlinuxcn.org/wiki/")
+
+
+def _selector(css: str) -> lxml.cssselect.CSSSelector:
+    # same as HtmlElement.cssselect, but translated to XPath only once
+    return lxml.cssselect.CSSSelector(css, translator="html")
+
+
+select_useless = _selector(
+    "#archnavbar, #mw-navigation, header.mw-header, .vector-sitenotice-container, .vector-page-toolbar, #p-lang-btn, .mw-editsection"
+)
+select_content = _selector("#content")
+select_footer = _selector("#footer")
+select_stylesheets = lxml.etree.XPath('//head/link[@rel="stylesheet"]')
+select_links = _selector("a")
+select_images = _selector("img")
+select_printfooter = _selector("div.printfooter")
+select_footer_info = _selector("#footer-info")
+
 
 class Optimizer:
+    # namespaces whose pages are stored in the language subdirectory
+    lang_namespaces = frozenset([
+        "Talk",
+        "ArchWiki",
+        "ArchWiki_talk",
+        "Template",
+        "Template_talk",
+        "Help",
+        "Help_talk",
+        "Category",
+        "Category_talk",
+    ])
+
+    # file name patterns per namespace, default_filename_pattern for the others
+    filename_patterns = {
+        "": "{base}/{langsubtag}/{title}.html",
+        "File": "{base}/{namespace}:{title}",
+        **dict.fromkeys(lang_namespaces, "{base}/{langsubtag}/{namespace}:{title}.html"),
+    }
+    default_filename_pattern = "{base}/{namespace}:{title}.html"
+
     def __init__(
         self,
         api: API,
@@ -31,8 +80,17 @@ class Optimizer:
         self.langs = langs or ws.ArchWiki.lang.get_language_tags()
         self.variant = variant
 
+        # memoized results of get_local_filename
+        self._filename_cache: dict[tuple[str, str], str | None] = {}
+        # map of all redirects on the wiki, fetched or loaded on first use
+        self._redirects: dict[str, str] | None = None
+
     def get_local_filename(self, title: str, basepath: str) -> str | None:
         """Return file name where the given page should be stored, relative to 'basepath'."""
+        key = (title, basepath)
+        if key in self._filename_cache:
+            return self._filename_cache[key]
+
         # title, lang = ws.ArchWiki.lang.detect_language(title)
         # langsubtag = ws.ArchWiki.lang.tag_for_langname(lang)
 
@@ -51,34 +109,73 @@ class Optimizer:
             h.update(title.encode("utf-8"))
             title = h.hexdigest()
 
-        # select pattern per namespace
-        if namespace == "":
-            pattern = "{base}/{langsubtag}/{title}.{ext}"
-        elif namespace in [
-            "Talk",
-            "ArchWiki",
-            "ArchWiki_talk",
-            "Template",
-            "Template_talk",
-            "Help",
-            "Help_talk",
-            "Category",
-            "Category_talk",
-        ]:
-            pattern = "{base}/{langsubtag}/{namespace}:{title}.{ext}"
-        elif namespace == "File":
-            pattern = "{base}/{namespace}:{title}"
-        else:
-            pattern = "{base}/{namespace}:{title}.{ext}"
-
+        pattern = self.filename_patterns.get(namespace, self.default_filename_pattern)
         path = pattern.format(
-            base=basepath,
-            langsubtag=self.variant,
-            namespace=namespace,
-            title=title,
-            ext="html",
+            base=basepath, langsubtag=self.variant, namespace=namespace, title=title
         )
-        return os.path.normpath(path)
+
+        # the patterns cannot introduce '..' or duplicate separators, so the
+        # path needs to be normalized only if the base path is '.' (the prefix
+        # is dropped), not normalized (e.g. a trailing slash), or the title
+        # contains separators (subpages)
+        if "/" in title or basepath == "." or basepath != os.path.normpath(basepath):
+            path = os.path.normpath(path)
+
+        self._filename_cache[key] = path
+        return path
+
+    def redirects(self) -> dict[str, str]:
+        """
+        Return the map of all redirects on the wiki (source -> 'target' or
+        'target#fragment'), fetched by wiki-scripts on first use.
+        """
+        if self._redirects is None:
+            self._set_redirects(self.api.redirects.map)
+        return self._redirects
+
+    def _set_redirects(self, redirects: dict[str, str]) -> None:
+        # many redirects point to the same page, share the target strings
+        # (in place, the map is not copied)
+        for source, target in redirects.items():
+            redirects[source] = sys.intern(target)
+        self._redirects = redirects
+
+    def resolve_redirect(self, title: str) -> str | None:
+        """Return target of the redirect 'title', or None if it is not a redirect."""
+        return self.redirects().get(title.replace("_", " "))
+
+    def load_redirects_cache(self, path: str, max_age: datetime.timedelta) -> bool:
+        """
+        Load the redirects map saved by a previous run from 'path', unless the
+        file is older than 'max_age', so that it does not have to be fetched
+        from the wiki. Returns True if the cache was loaded.
+        """
+        if not os.path.exists(path):
+            return False
+        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path), tz=datetime.UTC)
+        if datetime.datetime.now(datetime.UTC) - mtime > max_age:
+            return False
+        try:
+            with open(path, "r") as fd:
+                redirects = json.load(fd)
+        except (OSError, ValueError):
+            # unreadable or truncated cache, fetch the redirects again
+            return False
+        if not isinstance(redirects, dict):
+            return False
+        self._set_redirects(redirects)
+        return True
+
+    def save_redirects_cache(self, path: str) -> None:
+        """Save the redirects map into 'path', if it was needed in this run."""
+        if self._redirects is None:
+            return
+        # write a temporary file first, an interrupted run must not leave
+        # a truncated cache behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(self._redirects, fd, ensure_ascii=False)
+        os.replace(tmp_path, path)
 
     def optimize(self, title: str, html_content: str) -> str:
         # path relative from the HTML file to base output directory
@@ -108,9 +205,7 @@ class Optimizer:
     def strip_page(self, root):
         """remove elements useless in offline browsing"""
 
-        for e in root.cssselect(
-            "#archnavbar, #mw-navigation, header.mw-header, .vector-sitenotice-container, .vector-page-toolbar, #p-lang-btn, .mw-editsection"
-        ):
+        for e in select_useless(root):
             e.getparent().remove(e)
 
         # strip comments (including IE 6/7 fixes, which are useless for an Arch package)
@@ -123,15 +218,15 @@ class Optimizer:
         """fix page layout after removing some elements"""
 
         # in case of select-by-id a list with max one element is returned
-        for c in root.cssselect("#content"):
+        for c in select_content(root):
             c.set("style", "margin: 0")
-        for f in root.cssselect("#footer"):
+        for f in select_footer(root):
             f.set("style", "margin: 0")
 
     def replace_css_links(self, root, css_path):
         """force using local CSS"""
 
-        links = root.xpath('//head/link[@rel="stylesheet"]')
+        links = select_stylesheets(root)
 
         # overwrite first
         links[0].set("href", css_path)
@@ -143,25 +238,18 @@ class Optimizer:
     def update_links(self, root, relbase):
         """change "internal" wiki links into relative"""
 
-        for a in root.cssselect("a"):
+        for a in select_links(root):
             href = a.get("href")
-            if href is not None:
+            if href is not None and href.startswith(wiki_link_prefixes):
                 href = urllib.parse.unquote(href)
-                # matching full URL is necessary for interlanguage links
-                match = re.match(
-                    "^(https://wiki.archlinuxcn.org)?/wiki/(?P<title>.+?)(?:#(?P<fragment>.+))?$",
-                    str(href),
-                )
+                match = wiki_link_re.match(href)
                 if match:
-                    title = self.api.redirects.resolve(match.group("title"))
+                    title = self.resolve_redirect(match.group("title"))
                     if title is None:
                         title = match.group("title")
-                    try:
-                        title, fragment = title.split("#", maxsplit=1)
-                        # FIXME has to be dot-encoded
-                        fragment = fragment.replace(" ", "_")
-                    except ValueError:
-                        fragment = ""
+                    title, _, fragment = title.partition("#")
+                    # FIXME has to be dot-encoded
+                    fragment = fragment.replace(" ", "_")
                     # explicit fragment overrides the redirect
                     if match.group("fragment"):
                         fragment = match.group("fragment")
@@ -173,7 +261,7 @@ class Optimizer:
                         href += "#" + fragment
                     a.set("href", href)
 
-        for i in root.cssselect("img"):
+        for i in select_images(root):
             src = i.get("src")
             if src and src.startswith("/wzh/images/"):
                 src = os.path.join(relbase, "File:" + os.path.split(src)[1])
@@ -187,10 +275,10 @@ class Optimizer:
         the categories list from the real footer.)
         """
 
-        for printfooter in root.cssselect("div.printfooter"):
+        for printfooter in select_printfooter(root):
             printfooter.attrib.pop("class")
             printfooter.tag = "li"
-            f_list = root.cssselect("#footer-info")[0]
+            f_list = select_footer_info(root)[0]
             f_list.insert(0, printfooter)
             br = lxml.etree.Element("br")
             f_list.insert(3, br)
@@ -1,8 +1,11 @@
 #!/usr/bin/python3
 
+import argparse
 import datetime
+import os
 import sys
 
+import requests.adapters
 import ws.ArchWiki.lang as lang
 import ws.config
 from ws.client import API
@@ -16,6 +19,33 @@ def print_namespaces(api: API) -> None:
             ns = "Main"
         print("  %2d -- %s" % (id_, ns))
 
+def check_api_limits(api: API) -> None:
+    # queries with limit="max" get 5000/500 items per request with the
+    # apihighlimits right (bots, sysops) and only 500/50 without it
+    if "apihighlimits" not in api.user.rights:
+        print("Note: the current user does not have the 'apihighlimits' right, log in with a bot account to reduce the number of API queries.")
+
+def resize_connection_pool(api: API, workers: int) -> None:
+    # the worker threads and the main thread (API queries) use the session
+    # concurrently, by default requests keeps only 10 connections per host
+    # and discards (and later reopens) the others
+    pool_size = workers + 1
+    if pool_size > requests.adapters.DEFAULT_POOLSIZE:
+        for prefix, adapter in list(api.session.adapters.items()):
+            api.session.mount(
+                prefix,
+                requests.adapters.HTTPAdapter(
+                    pool_maxsize=pool_size, max_retries=adapter.max_retries
+                ),
+            )
+            adapter.close()
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {value}")
+    return number
+
 if __name__ == "__main__":
     argparser = ws.config.getArgParser(description="Download pages from Arch Wiki and optimize them for offline browsing")
     API.set_argparser(argparser)
@@ -25,27 +55,53 @@ if __name__ == "__main__":
     group.add_argument("--force", action="store_true", help="Ignore timestamp, always download the page from the wiki.")
     group.add_argument("--clean", action="store_true", help="Clean the output directory after downloading, useful for removing pages deleted/moved on the wiki. Warning: any unknown files found in the output directory will be deleted!")
     group.add_argument("--safe-filenames", action="store_true", help="Force using ASCII file names instead of the default Unicode.")
+    group.add_argument("--workers", type=positive_int, default=8, help="Number of files downloaded in parallel.")
+    group.add_argument("--redirects-cache-age", type=float, default=0, help="Reuse the redirects fetched by a previous run if they are not older than this number of hours (default: 0, i.e. disabled). Links to redirects created in the meantime are not resolved on pages downloaded from a cached map. --force invalidates the cache.")
     group.add_argument("--variant", type=str, required=True, help="zh variant")
 
     args = ws.config.parse_args(argparser)
 
     if args.force:
-        epoch = datetime.datetime.now(datetime.UTC)
+        # always download
+        epoch = None
     else:
         # this should be the date of the latest incompatible change
         epoch = datetime.datetime(2026, 1, 2, 0, 0, 0, tzinfo=datetime.UTC)
 
     sys.stdout.reconfigure(line_buffering=True)
     api = API.from_argparser(args)
+    resize_connection_pool(api, args.workers)
     optimizer = ArchWiki.Optimizer(api, args.output_directory, args.safe_filenames, variant=args.variant)
 
-    downloader = ArchWiki.Downloader(api, args.output_directory, epoch, optimizer=optimizer, variant=args.variant)
-    downloader.download_css()
-    print_namespaces(api)
-    for ns in ["0", "4", "12", "14"]:
-        downloader.process_namespace(ns)
+    redirects_cache = os.path.join(args.output_directory, ".redirects.cache")
+    use_cache = args.redirects_cache_age > 0
+    if args.force and os.path.exists(redirects_cache):
+        # invalidate the cache, it is rewritten below if the redirects are fetched
+        os.unlink(redirects_cache)
+    cache_loaded = use_cache and not args.force and optimizer.load_redirects_cache(
+        redirects_cache, datetime.timedelta(hours=args.redirects_cache_age)
+    )
+
+    try:
+        downloader = ArchWiki.Downloader(api, args.output_directory, epoch, optimizer=optimizer, variant=args.variant, workers=args.workers)
+        if cache_loaded:
+            # keep the cache when cleaning the output directory
+            downloader.files.append(redirects_cache)
+        downloader.download_css()
+        print_namespaces(api)
+        check_api_limits(api)
+        downloader.process_namespaces(["0", "4", "12", "14"])
+
+        downloader.download_images()
 
-    downloader.download_images()
+        if args.clean:
+            downloader.clean_output_directory()
+    finally:
+        # release the pooled connections of the API's HTTP session
+        api.session.close()
 
-    if args.clean:
-        downloader.clean_output_directory()
+    # save only a freshly fetched map, rewriting a loaded one would keep
+    # extending its lifetime (and do it after cleaning, otherwise it would be
+    # deleted as an unknown file)
+    if use_cache and not cache_loaded:
+        optimizer.save_redirects_cache(redirects_cache)